@@ -1,37 +1,42 @@
-from rich import print
-from typing import Any, List
+import asyncio
+import json
+import logging
+from typing import Any, Dict, List
 from langchain.agents import Tool, create_react_agent, AgentExecutor
 from langchain_openai import AzureChatOpenAI,ChatOpenAI
-from langchain.prompts import PromptTemplate
-from langchain.memory import ConversationBufferMemory
+from langchain.prompts import ChatPromptTemplate
+from langchain.memory import ConversationSummaryBufferMemory
 from typing import Union
 
-class ConversationBot:
-    def __init__(
-            self, llm: Union[ChatOpenAI,AzureChatOpenAI], toolModels: List,
-            customedPrefix: str, verbose: bool = False
-    ) -> Any:
-        tools = []
-
-        for ins in toolModels:
-            """初始化工具链 每个ins是一个实现了inference方法的class"""
-            func = getattr(ins, 'inference')
-            # 增强工具描述，帮助ReAct更好地选择工具
-            tools.append(
-                Tool(
-                    name=func.name,
-                    description=func.description,
-                    func=func
-                )
-            )
-        # 使用ReAct Agent替代ZeroShotAgent
-        self.agent_memory = ConversationBufferMemory(memory_key="chat_history")
-        
-        # 创建交通专业的prompt template
-        traffic_react_template = """
-{customedPrefix}
+log = logging.getLogger(__name__)
+
+# 规划器prompt 让LLM一次性输出一个JSON任务图 独立节点可以并行执行
+_PLANNER_TEMPLATE = """You are a traffic analysis planner. Given a user question and a list of tools,
+output ONLY a JSON array of tool-call steps, no prose. Each step is an object:
+{{"id": "<short unique id>", "tool": "<tool name>", "args": "<input string>", "deps": ["<ids of steps whose output this step needs>"]}}
+
+A step may reference the output of a dependency inside its args as $<dep id>.
+Steps without dependencies are independent and will run in parallel.
+If no tool is useful, output an empty array [].
+
+Available tools:
+{tools}
 
-🚦 作为交通分析专家，请遵循以下推理模式：
+Question: {input}
+JSON plan:"""
+
+# 汇总器prompt 把并行得到的Observation拼回去 生成最终回答
+_JOINER_TEMPLATE = """You are a traffic analysis expert. Answer the user question using the tool
+observations below. Do not mention the tools themselves, just give the final answer.
+
+Question: {input}
+
+{observations}
+
+Final answer:"""
+
+# 交通专业的ReAct模板 进程内只编译一次
+_TRAFFIC_REACT_TEMPLATE = """🚦 作为交通分析专家，请遵循以下推理模式：
 
 You have access to the following tools:
 {tools}
@@ -59,27 +64,182 @@ Final Answer: the final answer to the original input question
 
 Begin!
 
+Previous conversation history:
+{chat_history}
+
 Question: {input}
 Thought:{agent_scratchpad}"""
 
-        # 使用自定义模板
-        prompt = PromptTemplate.from_template(traffic_react_template)
-        prompt = prompt.partial(customedPrefix=customedPrefix)
-        
+# 静态前缀单独放进system消息：SDK发出的messages前缀逐字节稳定
+# OpenAI/Azure的服务端prompt caching才能命中
+_BASE_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "{customedPrefix}"),
+    ("human", _TRAFFIC_REACT_TEMPLATE),
+])
+
+def _recover_parsing_error(error) -> str:
+    """Action解析失败时把错误回灌给模型重试，而不是把原始输出直接当终答，
+    已经产出的轨迹不会被浪费"""
+    return (
+        "Your previous reply could not be parsed. Respond again using exactly one "
+        "of the two formats:\n"
+        "Action: <one of the available tool names>\nAction Input: <the input>\n"
+        "or\n"
+        "Final Answer: <your final answer>\n"
+        f"The parsing error was: {error}"
+    )
+
+# Tool对象按toolModels列表缓存 每请求克隆bot时不用重建
+_TOOL_CACHE: Dict[int, List[Tool]] = {}
+
+def _build_tools(toolModels: List) -> List[Tool]:
+    """初始化工具链 每个ins是一个实现了inference方法的class"""
+    key = id(toolModels)
+    if key not in _TOOL_CACHE:
+        _TOOL_CACHE[key] = [
+            Tool(
+                name=ins.inference.name,
+                description=ins.inference.description,
+                func=ins.inference
+            )
+            for ins in toolModels
+        ]
+    return _TOOL_CACHE[key]
+
+
+class ConversationBot:
+    def __init__(
+            self, llm: Union[ChatOpenAI,AzureChatOpenAI], toolModels: List,
+            customedPrefix: str, verbose: bool = False
+    ) -> Any:
+        tools = _build_tools(toolModels)
+        self.llm = llm
+        self.tools = tools
+        # 按名字索引工具 规划器执行时用
+        self.tool_map = {tool.name: tool for tool in tools}
+        # 使用ReAct Agent替代ZeroShotAgent
+        # 超过token上限的旧轮次压缩成摘要 prompt长度不再随轮数线性增长
+        self.agent_memory = ConversationSummaryBufferMemory(
+            llm=llm,
+            max_token_limit=800,
+            memory_key="chat_history",
+            return_messages=False
+        )
+
+        # 使用自定义模板 partial只是浅拷贝 代价是μs级
+        prompt = _BASE_PROMPT.partial(customedPrefix=customedPrefix)
+
         agent = create_react_agent(llm, tools, prompt)
         self.agent_chain = AgentExecutor(
-            agent=agent, 
+            agent=agent,
             tools=tools,
             verbose=verbose,
             memory=self.agent_memory,
-            max_iterations=12, 
+            max_iterations=12,
             early_stopping_method="generate",
-            handle_parsing_errors="Use the LLM output directly as your final answer!"
+            handle_parsing_errors=_recover_parsing_error
         )
     def dialogue(self, input: str):
-        print('TransGPT is running with ReAct reasoning, Please wait for a moment...')
+        if log.isEnabledFor(logging.INFO):
+            log.info('TransGPT is running with ReAct reasoning, Please wait for a moment...')
         res = self.agent_chain.invoke(
                 {"input":input}
             )
         # print('History: ', self.agent_memory.buffer)
         return res["output"]
+
+    async def plan_and_execute(self, input: str) -> str:
+        """规划-执行模式：先让LLM输出任务图，相互独立的工具并行跑，
+        端到端耗时从工具时延之和降到max()。规划失败时回退到ReAct循环。"""
+        steps = await self._plan(input)
+        if steps is None:
+            # 规划器输出不可解析 回退到顺序的ReAct agent
+            return await asyncio.to_thread(self.dialogue, input)
+        if not steps:
+            # 不需要工具 直接让LLM回答
+            res = await self.llm.ainvoke(input)
+            answer = res.content
+        else:
+            results = await self._execute_plan(steps)
+            observations = "\n".join(
+                f"Observation[{step_id}]: {result}"
+                for step_id, result in results.items()
+            )
+            res = await self.llm.ainvoke(
+                _JOINER_TEMPLATE.format(input=input, observations=observations)
+            )
+            answer = res.content
+        # 与agent_chain共享同一份记忆 两种模式的历史保持一致
+        # save_context可能同步调用摘要LLM 下放到线程免得压住事件循环
+        await asyncio.to_thread(
+            self.agent_memory.save_context, {"input": input}, {"output": answer}
+        )
+        return answer
+
+    async def _plan(self, input: str):
+        """调用一次LLM生成JSON任务图，返回step列表；解析失败返回None"""
+        tool_lines = "\n".join(
+            f"- {tool.name}: {tool.description.strip()}" for tool in self.tools
+        )
+        res = await self.llm.ainvoke(
+            _PLANNER_TEMPLATE.format(tools=tool_lines, input=input)
+        )
+        text = res.content.strip()
+        # 容忍模型包一层markdown代码块
+        if text.startswith("```"):
+            text = text.strip("`")
+            if text.startswith("json"):
+                text = text[4:]
+        try:
+            steps = json.loads(text)
+        except json.JSONDecodeError:
+            return None
+        if not isinstance(steps, list):
+            return None
+        # 工具名、id唯一性、deps可解析且无环都要验证 否则执行器会
+        # KeyError或互相等待挂死 这些都触发回退到ReAct
+        ids = set()
+        for step in steps:
+            if not isinstance(step, dict) or step.get("tool") not in self.tool_map:
+                return None
+            step_id = step.get("id")
+            if not isinstance(step_id, (str, int)) or step_id in ids:
+                return None
+            ids.add(step_id)
+        deps_map = {}
+        for step in steps:
+            deps = step.get("deps", [])
+            if not isinstance(deps, list):
+                return None
+            for dep in deps:
+                if not isinstance(dep, (str, int)) or dep not in ids:
+                    return None
+            deps_map[step["id"]] = set(deps)
+        # Kahn式检环：始终能找到deps已全部解析的节点 否则图里有环
+        resolved = set()
+        while deps_map:
+            ready = [sid for sid, deps in deps_map.items() if deps <= resolved]
+            if not ready:
+                return None
+            for sid in ready:
+                resolved.add(sid)
+                del deps_map[sid]
+        return steps
+
+    async def _execute_plan(self, steps: List[Dict]) -> Dict[str, str]:
+        """按依赖关系调度任务图：每个节点一个task，deps就绪即刻起跑，
+        无依赖的节点天然并发。工具是同步函数，用to_thread下放。"""
+        futures: Dict[str, asyncio.Future] = {}
+
+        async def _run(step: Dict) -> str:
+            args = str(step.get("args", ""))
+            for dep in step.get("deps", []):
+                dep_result = await futures[dep]
+                args = args.replace(f"${dep}", dep_result)
+            tool = self.tool_map[step["tool"]]
+            return await asyncio.to_thread(tool.func, args)
+
+        for step in steps:
+            futures[step["id"]] = asyncio.ensure_future(_run(step))
+        await asyncio.gather(*futures.values())
+        return {step_id: future.result() for step_id, future in futures.items()}
@@ -14,6 +14,9 @@ import gradio as gr
 # import openai.api_requestor
 # openai.api_requestor.TIMEOUT_SECS = 30
 
+# 每次回答都要抽取文件名 正则在模块级编译一次
+FILENAME_REGEX = re.compile(r'`([^`]+)`')
+
 # ------------------------------------------------------------------------------
 # --ZH 初始化 LLM
 # --EN Initialize a LLM
@@ -125,9 +128,8 @@ def reset(chat_history: list, thoughts: str):
 
 def respond(msg: str, chat_history: list, thoughts: str):
     res = bot.dialogue(msg)
-    regex = re.compile(r'`([^`]+)`')
     try:
-        filenames = regex.findall(res)
+        filenames = FILENAME_REGEX.findall(res)
     except AttributeError:
         filenames = None
     if filenames:
@@ -23,7 +23,7 @@ class demo_longhua_solution :
     def __init__(self):
         pass
 
-    @traffictool(name="demo_longhua_simulation",
+    @traffictool(name="demo_longhua_solution",
                  description="""When the user wants you to solve the traffic congestion in Longhua District, the following suggestions will be returned"""
                  )
     def inference(self,input_param:str) ->str :
@@ -1,22 +1,54 @@
 from __future__ import annotations
-from typing import Any, Dict, List, Optional
+import json
+import logging
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
 from uuid import UUID
 from langchain.callbacks.base import BaseCallbackHandler
 from langchain.schema import AgentAction, AgentFinish
-from rich import print
+
+log = logging.getLogger("agent")
+
+
+class AgentTraceHandler(BaseCallbackHandler):
+    """结构化trace：每个agent事件写一行JSON到logging，替代verbose的终端输出"""
+
+    def on_agent_action(self, action: AgentAction, *, run_id: UUID, parent_run_id: UUID | None = None, **kwargs: Any) -> Any:
+        if log.isEnabledFor(logging.INFO):
+            log.info(json.dumps(
+                {"event": "agent_action", "tool": action.tool, "input": str(action.tool_input)},
+                ensure_ascii=False
+            ))
+
+    def on_tool_end(self, output: str, *, run_id: UUID, parent_run_id: UUID | None = None, **kwargs: Any) -> Any:
+        if log.isEnabledFor(logging.INFO):
+            log.info(json.dumps(
+                {"event": "tool_end", "output": str(output)[:200]},
+                ensure_ascii=False
+            ))
+
+    def on_agent_finish(self, finish: AgentFinish, *, run_id: UUID, parent_run_id: UUID | None = None, **kwargs: Any) -> Any:
+        if log.isEnabledFor(logging.INFO):
+            log.info(json.dumps(
+                {"event": "agent_finish", "output": str(finish.return_values.get("output", ""))[:200]},
+                ensure_ascii=False
+            ))
 
 
 class CustomHandler(BaseCallbackHandler):
-    def __init__(self) -> None:
+    def __init__(self, maxlen: int = 64) -> None:
         super().__init__()
-        self.memory: List[List[str]] = [[]]
+        # 环形缓冲 只保留最近maxlen个回答的记忆 常驻服务不再无界增长
+        self.memory: Deque[List[str]] = deque([[]], maxlen=maxlen)
 
     def on_agent_finish(self, finish: AgentFinish, *, run_id: UUID, parent_run_id: UUID | None = None, **kwargs: Any) -> Any:
         """当agent结束推理的时候新开一个记忆,每一个回答的记忆是一个List"""
         self.memory.append([])
-        return super().on_agent_finish(finish, run_id=run_id, parent_run_id=parent_run_id, **kwargs)
 
     def on_agent_action(self, action: AgentAction, *, run_id: UUID, parent_run_id: UUID | None = None, **kwargs: Any) -> Any:
         """每一次action进行记忆"""
         self.memory[-1].append(action.log)
-        return super().on_agent_action(action, run_id=run_id, parent_run_id=parent_run_id, **kwargs)
+
+    def snapshot(self) -> List[List[str]]:
+        """拷贝一份当前记忆 诊断用"""
+        return list(self.memory)
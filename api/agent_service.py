@@ -1,6 +1,10 @@
 import os
+import re
+import time
 import yaml
 import asyncio
+import threading
+import httpx
 from typing import Dict, Any
 from langchain_openai import AzureChatOpenAI, ChatOpenAI
 from TrafficSense.TrafficTools import (
@@ -9,19 +13,123 @@ from TrafficSense.TrafficTools import (
     demo_longhua_solution
 )
 from TrafficSense.Conversationbot import ConversationBot
+from TrafficSense.callbackHandler import AgentTraceHandler
+from api.cache import ResponseCache
+
+# rich-rendered verbose output serializes on stdout under load; opt back in
+# for local debugging only
+_VERBOSE = os.environ.get("AGENT_VERBOSE") == "1"
+
+# Matches a completed Action/Action Input pair inside the streaming buffer,
+# before the model has finished emitting the rest of the step
+_ACTION_RE = re.compile(r"Action:\s*(\S+)\s*\n\s*Action Input:\s*(.+?)\n")
+
+# The executor binds stop=["\nObservation"], so a step's stream usually ends
+# right after the Action Input text with no trailing newline — at stream end
+# the pair terminates at end-of-buffer instead
+_ACTION_END_RE = re.compile(r"Action:\s*(\S+)\s*\n\s*Action Input:\s*(.+?)\s*$")
+
+def _normalize_action_input(text: str) -> str:
+    """Normalize the way the executor's ReAct output parser does (strip
+    spaces, then surrounding quotes) so a speculative run's key lines up
+    with the tool input the executor will call with"""
+    return text.strip(" ").strip('"')
+
+async def _await_task(task):
+    return await task
+
+# One connection pool shared by every LLM instance (batch bots included):
+# keep-alive skips per-call TLS handshakes and HTTP/2 multiplexes concurrent
+# requests to the LLM endpoint over few connections
+_HTTPX_ASYNC = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    timeout=60,
+)
+
+async def aclose_shared_client():
+    """Close the shared LLM connection pool; called from the app lifespan"""
+    await _HTTPX_ASYNC.aclose()
+
+# Streaming token-classifier states. A sentinel ("Thought:", "Action:",
+# "Final Answer:") can only complete at the newest token boundary, so a short
+# rolling tail is enough to track which section the stream is inside
+_THOUGHT, _ACTION, _FINAL = 0, 1, 2
+
+# One alternation scans the tail in a single pass; the latest sentinel wins
+_SENTINEL_RE = re.compile(r"Final Answer:|Action:|Thought:")
+_SENTINEL_TO_STATE = {
+    "Final Answer:": _FINAL,
+    "Action:": _ACTION,
+    "Thought:": _THOUGHT,
+}
+_STATE_TO_TYPE = {
+    _THOUGHT: "thought_token",
+    _ACTION: "action_token",
+    _FINAL: "response_token",
+}
+
+# At most this many speculative tool runs are tracked per stream; the oldest
+# is cancelled and evicted first, so a misbehaving trajectory cannot pile up
+# background tasks
+_SPECULATIVE_MAX = 16
+
+# Consumed stream-buffer prefix is dropped once it passes this size, keeping
+# memory and scan bounds independent of response length
+_BUFFER_TRIM_THRESHOLD = 4096
+
+# Dynamic token batching: group same-type tokens into one frame, flushed by
+# count or by a small interval so time-to-first-token stays low
+_TOKEN_BATCH_SIZE = 5
+_TOKEN_FLUSH_INTERVAL = 0.02  # seconds
+
+# Fast-path intent router: the demo tools return canned strings, so queries
+# they obviously cover skip the ReAct loop entirely. Solution/result patterns
+# come first so e.g. "解决龙华拥堵" is not swallowed by the simulation route.
+_ROUTES = [
+    (re.compile(r"(解决|优化).*龙华"), demo_longhua_solution().inference),
+    (re.compile(r"(结果|效果|评估)"), demo_longhua_result().inference),
+    (re.compile(r"龙华.*(拥堵|状况|交通)"), demo_longhua_simulation().inference),
+]
+
+def _route(message: str):
+    """Return the canned tool answer for obvious demo queries, else None"""
+    for pattern, inference in _ROUTES:
+        if pattern.search(message):
+            return inference(message)
+    return None
+
+# Parsed once per process; workers re-initializing AgentService reuse it
+_CONFIG = None
+
+def _load_config() -> Dict[str, Any]:
+    global _CONFIG
+    if _CONFIG is None:
+        with open('config.yaml') as f:
+            _CONFIG = yaml.safe_load(f)
+    return _CONFIG
 
 class AgentService:
     """Service class to manage the Traffic Analysis Agent"""
     
-    def __init__(self):
+    def __init__(self, buffer_size: int = _TOKEN_BATCH_SIZE):
         self.bot = None
         self.streaming_handler = None
+        # Tokens per streamed frame before a size-triggered flush
+        self.buffer_size = buffer_size
+        self.cache = ResponseCache(os.environ.get("REDIS_URL"))
+        # In-flight speculative runs keyed by (tool, args-hash); consumed by
+        # the tool shims installed in _initialize_agent
+        self._speculative_results: Dict[tuple, tuple] = {}
+        # /api/chat runs chat_sync on worker threads; the shared bot's memory
+        # is not safe for parallel dialogues, so they take turns here
+        self._bot_lock = threading.Lock()
         self._initialize_agent()
     
     def _initialize_agent(self):
         """Initialize the LLM and ConversationBot"""
         # Load configuration
-        OPENAI_CONFIG = yaml.load(open('config.yaml'), Loader=yaml.FullLoader)
+        OPENAI_CONFIG = _load_config()
         
         # Initialize LLM based on config with streaming enabled
         if OPENAI_CONFIG['OPENAI_API_TYPE'] == 'azure':
@@ -34,7 +142,11 @@ class AgentService:
                 temperature=0,
                 max_tokens=4096,
                 request_timeout=60,
-                streaming=True  # Enable streaming
+                streaming=True,  # Enable streaming
+                http_async_client=_HTTPX_ASYNC,
+                # Stable key so Azure routes repeat prompts to the same
+                # prompt-cache shard
+                model_kwargs={"extra_body": {"prompt_cache_key": "trafficsense-v1"}}
             )
         elif OPENAI_CONFIG['OPENAI_API_TYPE'] == 'openai':
             os.environ["OPENAI_API_KEY"] = OPENAI_CONFIG['OPENAI_KEY']
@@ -43,7 +155,8 @@ class AgentService:
                 model='gpt-3.5-turbo-16k-0613',
                 max_tokens=4096,
                 request_timeout=60,
-                streaming=True  # Enable streaming
+                streaming=True,  # Enable streaming
+                http_async_client=_HTTPX_ASYNC
             )
         elif OPENAI_CONFIG['OPENAI_API_TYPE'] == 'openrouter':
             os.environ["OPENAI_API_KEY"] = OPENAI_CONFIG['OPENROUTER_API_KEY']
@@ -55,7 +168,8 @@ class AgentService:
                 request_timeout=60,
                 openai_api_base=OPENAI_CONFIG['OPENROUTER_API_BASE'],
                 openai_api_key=OPENAI_CONFIG['OPENROUTER_API_KEY'],
-                streaming=True  # Enable streaming
+                streaming=True,  # Enable streaming
+                http_async_client=_HTTPX_ASYNC
             )
         
         # Initialize tools
@@ -108,120 +222,352 @@ The new traffic stauts of these 5 intersections are as follows:
 According to the data above, after optimization, Traffic volume has increased at these intersections, but average speeds have slowed and time loss have become greater.
 """
         
-        # Initialize ConversationBot
-        self.bot = ConversationBot(llm, toolModels, botPrefix, verbose=True)
+        # Keep the building blocks so chat_batch can spin up fresh bots
+        self.llm = llm
+        self.toolModels = toolModels
+        self.botPrefix = botPrefix
+
+        # Initialize ConversationBot; trace goes to the structured logger
+        # instead of verbose stdout rendering
+        self.bot = ConversationBot(llm, toolModels, botPrefix, verbose=_VERBOSE)
+        self.bot.agent_chain.callbacks = [AgentTraceHandler()]
+
+        # Speculation runs the raw callables, while the executor-facing
+        # Tool.func is shimmed to consume an in-flight speculative result
+        # instead of running the tool a second time. Tool objects are cached
+        # across bots, so unwrap any shim a previous init installed.
+        self._tool_funcs = {}
+        for tool in self.bot.tool_map.values():
+            raw = getattr(tool.func, '_raw_func', tool.func)
+            self._tool_funcs[tool.name] = raw
+            tool.func = self._wrap_tool_func(tool.name, raw)
+
+    def _wrap_tool_func(self, tool_name, tool_func):
+        """Executor-facing shim around a tool: if a speculative run for the
+        same call is in flight, wait for it and return its result"""
+        def wrapped(tool_input: str) -> str:
+            key = (tool_name, hash(_normalize_action_input(str(tool_input))))
+            entry = self._speculative_results.pop(key, None)
+            if entry is not None:
+                task, loop = entry
+                try:
+                    # Runs on an executor worker thread, so blocking here
+                    # while the loop thread finishes the task is safe
+                    return asyncio.run_coroutine_threadsafe(
+                        _await_task(task), loop
+                    ).result(timeout=60)
+                # CancelledError is a BaseException, so name it explicitly:
+                # a run evicted or cancelled mid-await must still fall back
+                except (Exception, asyncio.CancelledError):
+                    pass  # speculative run failed or was cancelled: run for real
+            return tool_func(tool_input)
+        wrapped._speculative_shim = True
+        wrapped._raw_func = tool_func
+        return wrapped
     
     async def chat_stream(self, message: str):
         """Process message with true LangChain astream_events for token streaming"""
         from api.models import StreamMessage
-        
-        # Track current agent state to determine token type
-        current_state = "thinking"  # thinking, acting, responding
+
+        # Obvious demo queries get the canned tool answer without any LLM call
+        routed = _route(message)
+        if routed is not None:
+            yield StreamMessage(type="response_complete", content=routed)
+            yield StreamMessage(type="done", content="")
+            return
+
+        # Repeat prompts short-circuit to the cached answer, skipping the
+        # LLM. The answer is already complete, so it ships as one frame —
+        # faking token-by-token delivery only added queue and frame overhead
+        # (a typing effect belongs in the client)
+        cached = await self.cache.aget(message)
+        if cached is not None:
+            yield StreamMessage(type="response_complete", content=cached)
+            yield StreamMessage(type="done", content="")
+            return
+
+        # Rolling-tail state machine classifying each token in O(1)
+        state = _THOUGHT
+        tail = ""
+        # Chunks are collected in a list and only joined into the scan buffer
+        # at scan points, avoiding an O(N) string copy per token
         accumulated_content = ""
-        
+        pending_chunks = []
+
+        # Speculative tool dispatch: once the streaming buffer contains a full
+        # Action/Action Input pair we can start the tool before the model
+        # finishes decoding, overlapping tool latency with the remaining tokens
+        speculative: Dict[tuple, asyncio.Task] = {}
+        spec_step = 0
+        action_scan_pos = 0
+
+        # Same-type tokens are batched into one frame before emission
+        token_buf = []
+        buf_state = state
+        last_flush = time.monotonic()
+
+        loop = asyncio.get_running_loop()
+
+        def _speculate(tool_name: str, tool_input: str) -> bool:
+            """Start tool_name in the background; True if a new run started"""
+            nonlocal spec_step
+            step = spec_step
+            spec_step += 1
+            tool_func = self._tool_funcs.get(tool_name)
+            if tool_func is None:
+                return False
+            key = (step, tool_name, hash(tool_input))
+            if len(speculative) >= _SPECULATIVE_MAX:
+                _discard(next(iter(speculative)))
+            task = asyncio.create_task(asyncio.to_thread(tool_func, tool_input))
+            speculative[key] = task
+            # Registered under the same key the executor's shim will look up
+            self._speculative_results[(tool_name, hash(tool_input))] = (task, loop)
+            return True
+
+        def _discard(key):
+            """Cancel one speculative run and drop its shared-registry entry"""
+            task = speculative.pop(key)
+            task.cancel()
+            reg_key = (key[1], key[2])
+            entry = self._speculative_results.get(reg_key)
+            if entry is not None and entry[0] is task:
+                del self._speculative_results[reg_key]
+
+        def _cancel_speculative():
+            for key in list(speculative):
+                _discard(key)
+
         # Use LangChain's astream_events for true token-level streaming
         async for event in self.bot.agent_chain.astream_events(
             {"input": message}, 
             version="v2"
         ):
             event_type = event["event"]
-            
+
+            # Any non-token event closes out the pending token batch so
+            # frames stay in order
+            if token_buf and event_type != "on_chat_model_stream":
+                yield StreamMessage(type=_STATE_TO_TYPE[buf_state], content=''.join(token_buf))
+                token_buf.clear()
+                last_flush = time.monotonic()
+
             # Stream LLM tokens in real-time with appropriate type
             if event_type == "on_chat_model_stream":
                 chunk = event["data"]["chunk"]
                 if hasattr(chunk, 'content') and chunk.content:
-                    accumulated_content += chunk.content
-                    
-                    # Determine token type based on current state and content
-                    token_type = self._determine_token_type(accumulated_content, current_state)
-                    
-                    # Update state based on content patterns
-                    if "Action:" in accumulated_content:
-                        current_state = "acting"
-                    elif "Final Answer:" in accumulated_content:
-                        current_state = "responding"
-                    elif "Thought:" in accumulated_content:
-                        current_state = "thinking"
-                    
-                    yield StreamMessage(type=token_type, content=chunk.content)
-            
+                    # No Action can follow the final answer, so the scan
+                    # buffer stops growing once the stream enters it
+                    if state != _FINAL:
+                        pending_chunks.append(chunk.content)
+
+                    # A sentinel always ends in ':', so only scan the tail
+                    # when the newest chunk could have completed one
+                    tail = (tail + chunk.content)[-32:]
+                    if ':' in chunk.content:
+                        last = None
+                        for last in _SENTINEL_RE.finditer(tail):
+                            pass
+                        if last is not None:
+                            state = _SENTINEL_TO_STATE[last.group()]
+
+                    # A state flip flushes the old batch before the type changes
+                    if token_buf and buf_state != state:
+                        yield StreamMessage(type=_STATE_TO_TYPE[buf_state], content=''.join(token_buf))
+                        token_buf.clear()
+                    token_buf.append(chunk.content)
+                    buf_state = state
+                    now = time.monotonic()
+                    if len(token_buf) >= self.buffer_size or now - last_flush >= _TOKEN_FLUSH_INTERVAL:
+                        yield StreamMessage(type=_STATE_TO_TYPE[buf_state], content=''.join(token_buf))
+                        token_buf.clear()
+                        last_flush = now
+
+                    # Fire the tool speculatively as soon as its Action block
+                    # is complete in the buffer. The scan is incremental: a
+                    # match can only complete when a newline arrives, and the
+                    # cursor never re-reads text that cannot start a match,
+                    # so total parsing work stays O(N) over the stream
+                    match = None
+                    if state != _FINAL and '\n' in chunk.content:
+                        accumulated_content += ''.join(pending_chunks)
+                        pending_chunks.clear()
+                        # Literal pre-check first: str.__contains__ is
+                        # memchr-fast and false for every newline outside an
+                        # Action block, so the regex rarely runs at all
+                        if "Action Input:" in accumulated_content[action_scan_pos:]:
+                            match = _ACTION_RE.search(accumulated_content, action_scan_pos)
+                        if match is None:
+                            last_start = accumulated_content.rfind("Action:", action_scan_pos)
+                            if last_start != -1:
+                                # Unfinished Action block: resume scanning at it
+                                action_scan_pos = last_start
+                            else:
+                                # Keep a small overlap in case a sentinel is
+                                # split across chunk boundaries
+                                action_scan_pos = max(action_scan_pos, len(accumulated_content) - 8)
+                            # Everything before the cursor is fully consumed;
+                            # shed it so the buffer cannot grow with the response
+                            if action_scan_pos > _BUFFER_TRIM_THRESHOLD:
+                                accumulated_content = accumulated_content[action_scan_pos:]
+                                action_scan_pos = 0
+                    if match:
+                        action_scan_pos = match.end()
+                        # group(1) is \S+ (no whitespace to strip); the input
+                        # is normalized like the executor's parser output
+                        tool_name = match.group(1)
+                        tool_input = _normalize_action_input(match.group(2))
+                        if _speculate(tool_name, tool_input):
+                            if token_buf:
+                                yield StreamMessage(type=_STATE_TO_TYPE[buf_state], content=''.join(token_buf))
+                                token_buf.clear()
+                                last_flush = time.monotonic()
+                            yield StreamMessage(type="action_speculative", content=f"预执行工具: {tool_name}")
+
+            # Each LLM call streams into a fresh buffer: text left over from
+            # the previous step must not concatenate into a bogus match
+            elif event_type == "on_chat_model_start":
+                accumulated_content = ""
+                pending_chunks.clear()
+                tail = ""
+                action_scan_pos = 0
+
+            # The executor's stop sequence cuts the stream right after the
+            # Action Input text (no trailing newline), so the completed pair
+            # is usually only visible once the model call ends
+            elif event_type == "on_chat_model_end":
+                if state != _FINAL:
+                    accumulated_content += ''.join(pending_chunks)
+                    pending_chunks.clear()
+                    if "Action Input:" in accumulated_content[action_scan_pos:]:
+                        match = _ACTION_END_RE.search(accumulated_content, action_scan_pos)
+                        if match:
+                            action_scan_pos = match.end()
+                            tool_name = match.group(1)
+                            tool_input = _normalize_action_input(match.group(2))
+                            if _speculate(tool_name, tool_input):
+                                yield StreamMessage(type="action_speculative", content=f"预执行工具: {tool_name}")
+
             # Capture agent thoughts
             elif event_type == "on_chain_start" and "AgentExecutor" in event.get("name", ""):
-                current_state = "thinking"
+                state = _THOUGHT
                 yield StreamMessage(type="thought_start", content="开始思考...")
-            
+
             # Capture tool calls
             elif event_type == "on_tool_start":
-                current_state = "acting"
                 tool_name = event.get("name", "Unknown")
-                yield StreamMessage(type="action_start", content=f"调用工具: {tool_name}")
-            
+                # Reconcile with speculative execution: the tool shim will
+                # consume a matching in-flight run; cancel runs the model
+                # abandoned
+                for key in list(speculative):
+                    if key[1] != tool_name:
+                        _discard(key)
+                if any(key[1] == tool_name for key in speculative):
+                    yield StreamMessage(type="action_start", content=f"调用工具: {tool_name} (复用预执行结果)")
+                else:
+                    yield StreamMessage(type="action_start", content=f"调用工具: {tool_name}")
+
             # Capture tool results
             elif event_type == "on_tool_end":
+                for key in [k for k in speculative if k[1] == event.get("name", "")]:
+                    task = speculative.pop(key)
+                    # Normally consumed by the shim already; drop a leftover
+                    # registry entry without cancelling the finished run
+                    entry = self._speculative_results.get((key[1], key[2]))
+                    if entry is not None and entry[0] is task:
+                        del self._speculative_results[(key[1], key[2])]
                 output = event["data"].get("output", "")
                 # Truncate long outputs
                 display_output = output[:200] + "..." if len(output) > 200 else output
                 yield StreamMessage(type="observation", content=f"工具结果: {display_output}")
-                current_state = "thinking"  # Back to thinking after tool execution
+                state = _THOUGHT  # Back to thinking after tool execution
             
             # Capture final result
             elif event_type == "on_chain_end" and "AgentExecutor" in event.get("name", ""):
                 output = event["data"].get("output", {})
                 if isinstance(output, dict) and "output" in output:
+                    await self.cache.aset(message, output["output"])
                     yield StreamMessage(type="response_complete", content=output["output"])
                 elif isinstance(output, str):
+                    await self.cache.aset(message, output)
                     yield StreamMessage(type="response_complete", content=output)
                 
                 # Send completion signal
+                _cancel_speculative()
                 yield StreamMessage(type="done", content="")
                 break
-            
+
             # Handle errors
             elif event_type == "on_chain_error":
+                _cancel_speculative()
                 error_msg = str(event["data"].get("error", "Unknown error"))
                 yield StreamMessage(type="error", content=f"执行错误: {error_msg}")
                 yield StreamMessage(type="done", content="")
                 break
     
-    def _determine_token_type(self, accumulated_content: str, current_state: str) -> str:
-        """Determine the appropriate token type based on content and state"""
-        # Check for specific patterns in the accumulated content
-        if "Thought:" in accumulated_content and not ("Action:" in accumulated_content or "Final Answer:" in accumulated_content):
-            return "thought_token"
-        elif "Action:" in accumulated_content and "Final Answer:" not in accumulated_content:
-            return "action_token"
-        elif "Final Answer:" in accumulated_content:
-            return "response_token"
-        else:
-            # Fallback to current state
-            if current_state == "thinking":
-                return "thought_token"
-            elif current_state == "acting":
-                return "action_token"
-            elif current_state == "responding":
-                return "response_token"
-            else:
-                return "token"  # Generic fallback
-    
-    async def _run_agent(self, message: str):
-        """Run the agent in an async context"""
-        loop = asyncio.get_event_loop()
-        # Run the synchronous agent in a thread pool
-        result = await loop.run_in_executor(None, self.bot.dialogue, message)
-        return result
-    
+    async def chat_batch(self, messages, max_concurrency: int = 8):
+        """Run many independent dialogues concurrently.
+
+        The shared bot's ConversationBufferMemory is not safe for parallel
+        dialogues, so each message gets a fresh single-shot ConversationBot;
+        a semaphore bounds how many agent runs are in flight at once. Each
+        bot runs in plan-and-execute mode, so a message's independent tool
+        calls also overlap; an unparseable plan falls back to the ReAct loop
+        inside plan_and_execute.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def _one(message: str) -> str:
+            cached = await self.cache.aget(message)
+            if cached is not None:
+                return cached
+            async with semaphore:
+                bot = ConversationBot(self.llm, self.toolModels, self.botPrefix, verbose=False)
+                response = await bot.plan_and_execute(message)
+            await self.cache.aset(message, response)
+            return response
+
+        return await asyncio.gather(*[_one(m) for m in messages])
+
     def chat_sync(self, message: str) -> Dict[str, Any]:
         """Process message synchronously (non-streaming)"""
         try:
-            # Capture thoughts by temporarily storing them
-            original_memory = self.bot.agent_memory.buffer
-            
-            # Get response
-            response = self.bot.dialogue(message)
-            
-            # Get updated memory for thoughts
-            new_memory = self.bot.agent_memory.buffer
-            thoughts = new_memory[len(original_memory):] if len(new_memory) > len(original_memory) else ""
+            # Obvious demo queries get the canned tool answer without any LLM call
+            routed = _route(message)
+            if routed is not None:
+                return {
+                    "response": routed,
+                    "thoughts": "",
+                    "status": "success"
+                }
+
+            # Repeat prompts short-circuit to the cached answer
+            cached = self.cache.get(message)
+            if cached is not None:
+                return {
+                    "response": cached,
+                    "thoughts": "",
+                    "status": "success"
+                }
+
+            # Concurrent /api/chat requests land on different worker threads
+            # but share one bot and its memory: serialize the dialogue plus
+            # the before/after memory read so they cannot interleave
+            with self._bot_lock:
+                # .buffer is the live message list, so snapshot its length
+                # before the dialogue mutates it in place
+                turn_start = len(list(self.bot.agent_memory.buffer))
+
+                # Get response
+                response = self.bot.dialogue(message)
+
+                # The messages appended this turn are the trace; join them
+                # into a string for ChatResponse.thoughts
+                new_messages = list(self.bot.agent_memory.buffer)[turn_start:]
+                thoughts = "\n".join(
+                    getattr(m, "content", str(m)) for m in new_messages
+                )
+            self.cache.set(message, response)
             
             return {
                 "response": response,
@@ -238,4 +584,5 @@ According to the data above, after optimization, Traffic volume has increased at
     def reset_conversation(self):
         """Reset the conversation history"""
         self.bot.agent_memory.clear()
+        self.cache.clear()
         return {"status": "success", "message": "Conversation history cleared"}
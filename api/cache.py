@@ -0,0 +1,126 @@
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Optional
+
+try:
+    import redis
+except ImportError:  # Redis is optional; L1 alone still works
+    redis = None
+
+_DEFAULT_TTL = 900  # seconds
+_L1_MAXSIZE = 512
+# How long a locally cached chat:gen value is trusted before re-reading it;
+# bounds the staleness window after another worker's clear()
+_GEN_REFRESH_INTERVAL = 1.0  # seconds
+
+
+class ResponseCache:
+    """Two-tier exact-match response cache for repeated chat prompts.
+
+    L1 is an in-process LRU dict, L2 is an optional Redis instance shared
+    across workers. Keys are sha1(message); entries expire after `ttl`
+    seconds. The generation counter lives in Redis so `clear()` in any
+    worker invalidates every worker's L2 entries within a refresh interval —
+    they are simply never read again and age out via their TTL. Without
+    Redis the counter is process-local and only covers this worker.
+
+    `get`/`set` do blocking Redis I/O; async callers use `aget`/`aset`,
+    which offload to a worker thread.
+    """
+
+    def __init__(self, redis_url: Optional[str] = None, ttl: int = _DEFAULT_TTL,
+                 maxsize: int = _L1_MAXSIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._generation = 0
+        self._gen_checked_at = float("-inf")
+        self._l1: OrderedDict = OrderedDict()  # key -> (expires_at, response)
+        self._redis = None
+        if redis is not None and redis_url:
+            try:
+                self._redis = redis.Redis.from_url(redis_url)
+                self._redis.ping()
+            except Exception:
+                # Redis unreachable: degrade silently to L1-only
+                self._redis = None
+
+    def _current_generation(self) -> int:
+        """Return the shared generation. The Redis value is re-read at most
+        every _GEN_REFRESH_INTERVAL, so key building does not add a network
+        round trip per lookup; a Redis outage degrades to the last value seen"""
+        now = time.monotonic()
+        if self._redis is not None and now - self._gen_checked_at >= _GEN_REFRESH_INTERVAL:
+            self._gen_checked_at = now
+            try:
+                value = self._redis.get("chat:gen")
+                self._generation = int(value) if value is not None else 0
+            except Exception:
+                pass
+        return self._generation
+
+    def _key(self, message: str) -> str:
+        digest = hashlib.sha1(message.encode("utf-8")).hexdigest()
+        return f"chat:{self._current_generation()}:{digest}"
+
+    def get(self, message: str) -> Optional[str]:
+        key = self._key(message)
+        entry = self._l1.get(key)
+        if entry is not None:
+            expires_at, response = entry
+            if expires_at > time.monotonic():
+                self._l1.move_to_end(key)
+                return response
+            del self._l1[key]
+        if self._redis is not None:
+            try:
+                value = self._redis.get(key)
+            except Exception:
+                return None
+            if value is not None:
+                response = value.decode("utf-8")
+                self._set_l1(key, response)
+                return response
+        return None
+
+    def set(self, message: str, response: str) -> None:
+        key = self._key(message)
+        self._set_l1(key, response)
+        if self._redis is not None:
+            try:
+                self._redis.setex(key, self.ttl, response)
+            except Exception:
+                pass
+
+    async def aget(self, message: str) -> Optional[str]:
+        """get() for the event loop: with Redis configured the lookup does
+        network I/O, so it runs on a worker thread"""
+        if self._redis is None:
+            return self.get(message)
+        return await asyncio.to_thread(self.get, message)
+
+    async def aset(self, message: str, response: str) -> None:
+        """set() for the event loop; see aget()"""
+        if self._redis is None:
+            self.set(message, response)
+            return
+        await asyncio.to_thread(self.set, message, response)
+
+    def _set_l1(self, key: str, response: str) -> None:
+        self._l1[key] = (time.monotonic() + self.ttl, response)
+        self._l1.move_to_end(key)
+        while len(self._l1) > self.maxsize:
+            self._l1.popitem(last=False)
+
+    def clear(self) -> None:
+        if self._redis is not None:
+            try:
+                self._generation = int(self._redis.incr("chat:gen"))
+                self._gen_checked_at = time.monotonic()
+                self._l1.clear()
+                return
+            except Exception:
+                pass
+        self._generation += 1
+        self._l1.clear()
@@ -1,6 +1,17 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from api.routes import router
+from api.agent_service import AgentService, aclose_shared_client
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Build the per-worker AgentService after uvicorn is up, off the event loop"""
+    app.state.agent_service = await asyncio.to_thread(AgentService)
+    yield
+    await aclose_shared_client()
 
 # Create FastAPI application
 app = FastAPI(
@@ -8,16 +19,25 @@ app = FastAPI(
     description="HTTP API for TrafficSenseAgent with streaming support",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    lifespan=lifespan
 )
 
-# Configure CORS
+# Configure CORS. Explicit origins let Starlette take its constant-header
+# fast path instead of echoing the Origin per request (wildcard plus
+# credentials is rejected anyway); restricting methods/headers keeps the
+# preflight response precomputed.
+ALLOWED_ORIGINS = tuple(
+    origin.strip()
+    for origin in os.environ.get("ALLOWED_ORIGINS", "http://localhost:3000").split(",")
+    if origin.strip()
+)
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # In production, specify actual origins
+    allow_origins=list(ALLOWED_ORIGINS),
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["content-type", "authorization"],
 )
 
 # Include API routes
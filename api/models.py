@@ -1,10 +1,19 @@
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 from datetime import datetime
 
 class ChatRequest(BaseModel):
     message: str
 
+class BatchChatRequest(BaseModel):
+    messages: List[str]
+    max_concurrency: int = 8
+
+class BatchChatResponse(BaseModel):
+    responses: List[str]
+    status: str = "success"
+    timestamp: datetime
+
 class ChatResponse(BaseModel):
     response: str
     thoughts: str
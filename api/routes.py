@@ -1,15 +1,25 @@
-import json
+import asyncio
 from datetime import datetime
-from fastapi import APIRouter, HTTPException
+
+import orjson
+from fastapi import APIRouter, Depends, HTTPException, Request
 from fastapi.responses import StreamingResponse
-from api.models import ChatRequest, ChatResponse, HealthResponse, ErrorResponse
+from api.models import (
+    BatchChatRequest,
+    BatchChatResponse,
+    ChatRequest,
+    ChatResponse,
+    HealthResponse,
+    ErrorResponse
+)
 from api.agent_service import AgentService
 
 # Initialize router
 router = APIRouter()
 
-# Initialize agent service (singleton)
-agent_service = AgentService()
+def get_agent_service(request: Request) -> AgentService:
+    """Per-worker AgentService built in the app lifespan (see api/main.py)"""
+    return request.app.state.agent_service
 
 @router.get("/health", response_model=HealthResponse)
 async def health_check():
@@ -17,36 +27,39 @@ async def health_check():
     return HealthResponse(timestamp=datetime.now())
 
 @router.post("/chat/stream")
-async def chat_stream(request: ChatRequest):
+async def chat_stream(request: ChatRequest, agent_service: AgentService = Depends(get_agent_service)):
     """Streaming chat endpoint using Server-Sent Events"""
     try:
         async def generate():
             async for message in agent_service.chat_stream(request.message):
-                # Format as plain JSON without SSE prefix
-                data = message.dict()
-                yield f"{json.dumps(data, ensure_ascii=False)}\n"
-        
+                # One JSON object per line; orjson serializes straight to
+                # UTF-8 bytes, no per-token dict() + ensure_ascii pass
+                yield orjson.dumps(
+                    {"type": message.type, "content": message.content}
+                ) + b"\n"
+
         return StreamingResponse(
             generate(),
-            media_type="text/plain",
+            media_type="application/x-ndjson",
             headers={
                 "Cache-Control": "no-cache",
                 "Connection": "keep-alive",
-                "Content-Type": "text/event-stream",
             }
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, agent_service: AgentService = Depends(get_agent_service)):
     """Non-streaming chat endpoint"""
     try:
-        result = agent_service.chat_sync(request.message)
-        
+        # chat_sync drives the fully synchronous AgentExecutor; run it on a
+        # worker thread so concurrent requests don't serialize on the event loop
+        result = await asyncio.to_thread(agent_service.chat_sync, request.message)
+
         if result["status"] == "error":
             raise HTTPException(status_code=500, detail=result["response"])
-        
+
         return ChatResponse(
             response=result["response"],
             thoughts=result["thoughts"],
@@ -55,8 +68,17 @@ async def chat(request: ChatRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/chat/batch", response_model=BatchChatResponse)
+async def chat_batch(request: BatchChatRequest, agent_service: AgentService = Depends(get_agent_service)):
+    """Run a batch of prompts through the agent with bounded concurrency"""
+    try:
+        responses = await agent_service.chat_batch(request.messages, request.max_concurrency)
+        return BatchChatResponse(responses=responses, timestamp=datetime.now())
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @router.post("/reset")
-async def reset_conversation():
+async def reset_conversation(agent_service: AgentService = Depends(get_agent_service)):
     """Reset conversation history"""
     try:
         result = agent_service.reset_conversation()